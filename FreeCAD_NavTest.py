@@ -8,14 +8,22 @@ __license__ = "GPL"
 __email__ = "support@747developments.com"
 __version__ = "1.2"
 
-from math import sin, cos, pi, atan
-import time
+from math import atan
 
 import FreeCAD
 import WorkingPlane
 from PySide import QtGui, QtCore
 from pivy import coin
 
+from walkview_kernels import load_kernels
+
+# Ahead-of-time compiled kernels when an up to date build exists, else JIT
+_kernels = load_kernels()
+fast_sin = _kernels.fast_sin
+fast_cos = _kernels.fast_cos
+update_az = _kernels.update_az
+update_el = _kernels.update_el
+
 ## INPUTS
 DEFAULT_WALK_SPEED_MM = 100.0  # camera moves default speed by keypress
 DEFAULT_WALK_SPEED_INCREMENT = 10.0  # speed increment
@@ -23,12 +31,108 @@ DEFAULT_WALK_SPEED_INCREMENT = 10.0  # speed increment
 DEFAULT_MOUSE_SPEED = 50
 DEFAULT_MOUSE_SPEED_INCREMENT = 5
 MOUSE_SPEED_DIVIDER = 10000
+FRAME_FLUSH_INTERVAL_MS = 8  # coalesce camera updates to ~120 frames/s
+KEY_COOLDOWN_MS = 300  # ignore repeats of one-shot actions for this long
+
+DEBUG = False  # catch and print exceptions raised in the event callbacks
 
 DEFAULT_AZIMUTH_INCREMENT_DEG = 1
 DEFAULT_ELEVATION_INCREMENT_DEG = 1
 
-DEG2RAD = pi / 180.0
-RAD2DEG = 180.0 / pi
+## WALK MODES
+WALK_FORWARD = 0
+WALK_BACKWARD = 1
+WALK_LEFT = 2
+WALK_RIGHT = 3
+WALK_DOWN = 4
+WALK_UP = 5
+
+
+## MOVEMENT KEY CODES, resolved once so the dispatch does not go through pivy
+_KEY_W = int(coin.SoKeyboardEvent.W)
+_KEY_S = int(coin.SoKeyboardEvent.S)
+_KEY_A = int(coin.SoKeyboardEvent.A)
+_KEY_D = int(coin.SoKeyboardEvent.D)
+_KEY_Q = int(coin.SoKeyboardEvent.Q)
+_KEY_E = int(coin.SoKeyboardEvent.E)
+_KEY_ESCAPE = int(coin.SoKeyboardEvent.ESCAPE)
+
+
+## WalkState CLASS
+class WalkState:
+    """Numeric camera state updated on every input event"""
+
+    __slots__ = (
+        "x",
+        "y",
+        "z",
+        "azimuth",
+        "elevation",
+        "ca",
+        "sa",
+        "se",
+        "trig_dirty",
+        "walk_speed_mm",
+        "mouse_gain",
+        "d_az_init",
+        "d_el_init",
+        "pending_daz",
+        "pending_del",
+        "cam_dirty",
+        "committed",
+    )
+
+    def __init__(self, position, azimuth, elevation):
+        self.x = position[0]
+        self.y = position[1]
+        self.z = position[2]
+        self.azimuth = azimuth
+        self.elevation = elevation
+        self.walk_speed_mm = DEFAULT_WALK_SPEED_MM
+        self.mouse_gain = DEFAULT_MOUSE_SPEED / MOUSE_SPEED_DIVIDER
+
+        self.d_az_init = 0.0
+        self.d_el_init = 0.0
+
+        # Mouse deltas and camera moves accumulated between two frames
+        self.pending_daz = 0
+        self.pending_del = 0
+        self.cam_dirty = False
+        # Position last written to or read from the camera node
+        self.committed = (self.x, self.y, self.z)
+
+        # Trigonometry of the view angles, refreshed when they change
+        self.refresh_trig()
+
+    ## Recompute cached sin/cos of azimuth and elevation
+    def refresh_trig(self):
+        self.ca = fast_cos(self.azimuth)
+        self.sa = fast_sin(self.azimuth)
+        self.se = fast_sin(self.elevation)
+        self.trig_dirty = False
+
+    ## Move the camera one step in the given walk mode
+    def walk(self, mode):
+        speed = self.walk_speed_mm
+        if mode == WALK_FORWARD:
+            self.x += speed * self.ca
+            self.y += speed * self.sa
+            self.z += speed * self.se
+        elif mode == WALK_BACKWARD:
+            self.x -= speed * self.ca
+            self.y -= speed * self.sa
+            self.z -= speed * self.se
+        # cos(a + pi/2) == -sin(a), sin(a + pi/2) == cos(a)
+        elif mode == WALK_LEFT:
+            self.x -= speed * self.sa
+            self.y += speed * self.ca
+        elif mode == WALK_RIGHT:
+            self.x += speed * self.sa
+            self.y -= speed * self.ca
+        elif mode == WALK_DOWN:
+            self.z -= speed
+        elif mode == WALK_UP:
+            self.z += speed
 
 
 ## WalkView CLASS
@@ -40,37 +144,84 @@ class WalkView(QtGui.QDialog):
         self.view = view
         self.camera = FreeCADGui.ActiveDocument.ActiveView.getCameraNode()
         self.shut_down_flag = False
+        self._debug = DEBUG
 
         # Get actual camera position
         camera_position = self.camera.position.getValue()
-
-        # Assign actual camera position
-        self.x = camera_position[0]
-        self.y = camera_position[1]
-        self.z = camera_position[2]
         self.view_vector = Gui.ActiveDocument.ActiveView.getViewDirection()
 
+        azimuth = 0.0
+        elevation = 0.0
+        if self.view_vector[0] != 0:
+            azimuth = atan(self.view_vector[1] / self.view_vector[0])
+        if self.view_vector[1] != 0:
+            elevation = atan(self.view_vector[2] / self.view_vector[1])
+
+        # Hot numeric state lives in a slotted object, the Qt wrapper
+        # keeps its own instance dict so slots on the dialog would not help
+        self.state = WalkState(camera_position, azimuth, elevation)
+
         # Set default values
-        self.walk_speed_mm = DEFAULT_WALK_SPEED_MM
         self.walk_speed_increment = DEFAULT_WALK_SPEED_INCREMENT
         self.mouse_speed = DEFAULT_MOUSE_SPEED
         self.mouse_speed_increment = DEFAULT_MOUSE_SPEED_INCREMENT
         self.azimuth_increment = DEFAULT_AZIMUTH_INCREMENT_DEG
         self.elevation_increment = DEFAULT_ELEVATION_INCREMENT_DEG
 
-        self.azimuth = 0.0
-        self.elevation = 0.0
-        if self.view_vector[0] != 0:
-            self.azimuth = atan(self.view_vector[1] / self.view_vector[0])
-        if self.view_vector[1] != 0:
-            self.elevation = atan(self.view_vector[2] / self.view_vector[1])
-        self.d_az_init = 0.0
-        self.d_el_init = 0.0
-        self.d_az = 0.0
-        self.d_el = 0.0
+        # Reused pointAt arguments
+        self._up = coin.SbVec3f(0, 0, 1)
+        self._target = coin.SbVec3f(0, 0, 0)
 
         self.pressed_keys = []
 
+        self._flush_timer = QtCore.QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(FRAME_FLUSH_INTERVAL_MS)
+        self._flush_timer.timeout.connect(self._onFlushTimeout)
+
+        # Status bar is only refreshed when the shown speed changes
+        self._status_bar = FreeCADGui.getMainWindow().statusBar()
+        self._status_template = "W: Forward, S: Backward, A: Left, D: Right, Speed: %s"
+        self._last_shown_speed = None
+
+        # FreeCAD's own navigation (zoom, orbit, pan, Fit All) keeps moving
+        # the camera during the walk. The immediate (priority 0) sensor fires
+        # inside the write, so writes from _flushFrame can be told apart
+        self._writing_camera = False
+        self._camera_sensor = coin.SoFieldSensor(self._onCameraMoved, None)
+        self._camera_sensor.setPriority(0)
+        self._camera_sensor.attach(self.camera.position)
+
+        # One-shot actions currently ignoring repeated key events
+        self._cooldown = set()
+
+        # UI-only keys are bound as Qt shortcuts scoped to the 3D view, so
+        # they skip the coin event callback and leave the rest of FreeCAD alone
+        view_widget = self.view.graphicsView()
+        self._shortcuts = []
+        for key, slot in (
+            ("R", self._speed_up),
+            ("F", self._speed_down),
+            ("T", self._mouse_up),
+            ("G", self._mouse_down),
+            ("V", self._fit),
+        ):
+            shortcut = QtGui.QShortcut(QtGui.QKeySequence(key), view_widget)
+            shortcut.setContext(QtCore.Qt.WidgetWithChildrenShortcut)
+            shortcut.activated.connect(slot)
+            self._shortcuts.append(shortcut)
+
+        # Key dispatch table of the movement keys
+        self._key_handlers = {
+            _KEY_W: self._move_forward,
+            _KEY_S: self._move_back,
+            _KEY_A: self._strafe_left,
+            _KEY_D: self._strafe_right,
+            _KEY_Q: self._move_down,
+            _KEY_E: self._move_up,
+            _KEY_ESCAPE: self._quit,
+        }
+
         # Create mouse and keyboard event callbacks
         self.mouseEvent = self.view.addEventCallbackPivy(
             coin.SoLocation2Event.getClassTypeId(),
@@ -83,153 +234,212 @@ class WalkView(QtGui.QDialog):
 
     ## Update view by mouse motion callback
     def updateMouseMotion(self, mouseEvent):
-        try:
-            event = mouseEvent.getEvent()
-            if event.getTypeId() == coin.SoLocation2Event.getClassTypeId():
-
-                pos = event.getPosition()
-                self.d_az = int(pos[0])
-                self.d_el = int(pos[1])
-
-                self.azimuth += (self.d_az_init - self.d_az) * (
-                    self.mouse_speed / MOUSE_SPEED_DIVIDER
-                )
-                self.elevation += (self.d_el_init - self.d_el) * (
-                    self.mouse_speed / MOUSE_SPEED_DIVIDER
-                )
-                print(self.elevation)
-
-                self.d_az_init = self.d_az
-                self.d_el_init = self.d_el
-
-                self.updateViewVector()
-
-            # # If mouse motion is FROZEN only update the camera position
-            # else:
-            #     # Assign actual camera position
-            #     self.camera_position = self.camera.position.getValue()
-            #     self.x = self.camera_position[0]
-            #     self.y = self.camera_position[1]
-            #     self.z = self.camera_position[2]
+        if __debug__ and self._debug:
+            try:
+                self._handleMouseMotion(mouseEvent)
+            except Exception as ex:
+                print("Exception happened during mouse motion update: %s" % (ex))
+        else:
+            self._handleMouseMotion(mouseEvent)
 
-        except Exception as ex:
-            print("Exception happened during mouse motion update: %s" % (ex))
+    def _handleMouseMotion(self, mouseEvent):
+        event = mouseEvent.getEvent()
+        if event.getTypeId() == coin.SoLocation2Event.getClassTypeId():
+            state = self.state
+
+            pos = event.getPosition()
+            d_az = int(pos[0])
+            d_el = int(pos[1])
+            if d_az == state.d_az_init and d_el == state.d_el_init:
+                return
+            state.pending_daz += state.d_az_init - d_az
+            state.pending_del += state.d_el_init - d_el
+
+            state.d_az_init = d_az
+            state.d_el_init = d_el
+
+            self._scheduleFrame()
+
+    ## Schedule a camera update, the first request after idle is applied
+    ## at once, the following ones are coalesced until the flush timer fires
+    def _scheduleFrame(self):
+        if not self._flush_timer.isActive():
+            self._flushFrame()
+            self._flush_timer.start()
+
+    ## Flush timer callback, keeps ticking while there is work pending and
+    ## only goes idle after a tick with nothing to apply
+    def _onFlushTimeout(self):
+        state = self.state
+        pending = state.pending_daz or state.pending_del or state.cam_dirty
+        self._flushFrame()
+        if pending:
+            self._flush_timer.start()
+
+    ## Apply the accumulated camera moves and mouse motion in one go
+    def _flushFrame(self):
+        state = self.state
+
+        # Position goes first, pointAt orients from the current position
+        if state.cam_dirty:
+            self._writing_camera = True
+            self.camera.position.setValue((state.x, state.y, state.z))
+            self._writing_camera = False
+            state.committed = (state.x, state.y, state.z)
+            state.cam_dirty = False
+
+        if state.pending_daz or state.pending_del:
+            gain = state.mouse_gain
+            state.azimuth += state.pending_daz * gain
+            state.elevation += state.pending_del * gain
+            state.pending_daz = 0
+            state.pending_del = 0
+            state.trig_dirty = True
+
+            self.updateViewVector()
+
+        self._reflectStatus()
+
+    ## Show the walk speed in the status bar, only when it changed
+    def _reflectStatus(self):
+        walk_speed_mm = self.state.walk_speed_mm
+        if self._last_shown_speed != walk_speed_mm:
+            self._status_bar.showMessage(self._status_template % walk_speed_mm)
+            self._last_shown_speed = walk_speed_mm
+
+    ## Resync the cached camera position with the camera node, a key step
+    ## still waiting for the flush is moved along instead of dropped
+    def _invalidateCameraCache(self):
+        state = self.state
+        camera_position = self.camera.position.getValue()
+        x = camera_position[0]
+        y = camera_position[1]
+        z = camera_position[2]
+        committed_x, committed_y, committed_z = state.committed
+        state.x += x - committed_x
+        state.y += y - committed_y
+        state.z += z - committed_z
+        state.committed = (x, y, z)
+
+    ## Camera position sensor callback
+    def _onCameraMoved(self, data, sensor):
+        if not self._writing_camera:
+            self._invalidateCameraCache()
 
     ## Function to update the view vector
     def updateViewVector(self):
-        self.camera_position = self.camera.position.getValue()
-        self.view_vector = (
-            self.camera_position[0] + cos(self.azimuth),
-            self.camera_position[1] + sin(self.azimuth),
-            self.camera_position[2] + sin(self.elevation),
+        state = self.state
+        if state.trig_dirty:
+            state.refresh_trig()
+        self._target.setValue(
+            state.x + state.ca,
+            state.y + state.sa,
+            state.z + state.se,
         )
 
-        self.camera.pointAt(
-            coin.SbVec3f(
-                self.view_vector[0],
-                self.view_vector[1],
-                self.view_vector[2],
-            ),
-            coin.SbVec3f(0, 0, 1),
-        )
-        FreeCADGui.getMainWindow().statusBar().showMessage(
-            f"W: Forward, S: Backward, A: Left, D: Right, Speed: {self.walk_speed_mm}"
-        )
+        self.camera.pointAt(self._target, self._up)
 
     ## Function to update azimuth
     def updateAz(self, value, increment, positive_incr):
-        value_deg = value * RAD2DEG
-        value_deg = value_deg % 360
-        if positive_incr:
-            new_value = value_deg + increment
-        else:
-            new_value = value_deg - increment
-        return new_value * DEG2RAD
+        return update_az(value, increment, positive_incr)
 
     ## Function to update elevation
     def updateEl(self, value, increment, positive_incr):
-        value_deg = value * RAD2DEG
-        value_mod = value_deg % 360
-        if positive_incr:
-            new_value = value_deg + increment
-        else:
-            new_value = value_deg - increment
-        if new_value < 90 or new_value > 270:
-            new_value = value_mod
-        return new_value * DEG2RAD
+        return update_el(value, increment, positive_incr)
 
-    ## Hande keyboard controls
-    def updateKeyPressMotion(self, keyEvent):
-        try:
-            event = keyEvent.getEvent()
+    ## Return False while the action is cooling down, otherwise start its cooldown
+    def _debounce(self, tag, ms=KEY_COOLDOWN_MS):
+        if tag in self._cooldown:
+            return False
+        self._cooldown.add(tag)
+        QtCore.QTimer.singleShot(ms, lambda: self._cooldown.discard(tag))
+        return True
 
-            key_pressed = event.getKey()
-            key_state = event.getState()
+    ## Recompute the mouse motion multiplier after a mouse speed change
+    def _update_mouse_gain(self):
+        self.state.mouse_gain = self.mouse_speed / MOUSE_SPEED_DIVIDER
 
-            if key_pressed == coin.SoKeyboardEvent.ESCAPE:
-                self.endWalkTrough()
-                self.shut_down_flag = True
+    ## Key handlers
+    def _move_forward(self):
+        self.state.walk(WALK_FORWARD)
 
-            if key_pressed == coin.SoKeyboardEvent.W:
-                self.x += self.walk_speed_mm * cos(self.azimuth)
-                self.y += self.walk_speed_mm * sin(self.azimuth)
+    def _move_back(self):
+        self.state.walk(WALK_BACKWARD)
 
-                self.z += self.walk_speed_mm * sin(self.elevation)
+    def _strafe_left(self):
+        self.state.walk(WALK_LEFT)
 
-            if key_pressed == coin.SoKeyboardEvent.S:
-                self.y -= self.walk_speed_mm * sin(self.azimuth)
-                self.x -= self.walk_speed_mm * cos(self.azimuth)
+    def _strafe_right(self):
+        self.state.walk(WALK_RIGHT)
 
-                self.z -= self.walk_speed_mm * sin(self.elevation)
+    def _move_down(self):
+        self.state.walk(WALK_DOWN)
 
-            if key_pressed == coin.SoKeyboardEvent.A:
-                self.x += self.walk_speed_mm * cos(self.azimuth + pi / 2.0)
-                self.y += self.walk_speed_mm * sin(self.azimuth + pi / 2.0)
+    def _move_up(self):
+        self.state.walk(WALK_UP)
 
-            if key_pressed == coin.SoKeyboardEvent.D:
-                self.x -= self.walk_speed_mm * cos(self.azimuth + pi / 2.0)
-                self.y -= self.walk_speed_mm * sin(self.azimuth + pi / 2.0)
+    def _speed_up(self):
+        self.state.walk_speed_mm += self.walk_speed_increment
+        self._scheduleFrame()
 
-            if key_pressed == coin.SoKeyboardEvent.Q:
-                self.z -= self.walk_speed_mm
+    def _speed_down(self):
+        self.state.walk_speed_mm -= self.walk_speed_increment
+        self._scheduleFrame()
 
-            if key_pressed == coin.SoKeyboardEvent.E:
-                self.z += self.walk_speed_mm
+    def _mouse_up(self):
+        self.mouse_speed += self.mouse_speed_increment
+        self._update_mouse_gain()
 
-            if key_pressed == coin.SoKeyboardEvent.R:
-                self.walk_speed_mm += self.walk_speed_increment
+    def _mouse_down(self):
+        self.mouse_speed -= self.mouse_speed_increment
+        self._update_mouse_gain()
 
-            if key_pressed == coin.SoKeyboardEvent.F:
-                self.walk_speed_mm -= self.walk_speed_increment
+    def _fit(self):
+        if not self._debounce("V"):
+            return
+        # Commit pending moves first, the camera sensor picks up the fit
+        self._flushFrame()
+        self.fitObjectToWindow()
 
-            if key_pressed == coin.SoKeyboardEvent.T:
-                self.mouse_speed += self.mouse_speed_increment
+    def _quit(self):
+        self.endWalkTrough()
+        self.shut_down_flag = True
 
-            if key_pressed == coin.SoKeyboardEvent.G:
-                self.mouse_speed -= self.mouse_speed_increment
+    ## Hande keyboard controls
+    def updateKeyPressMotion(self, keyEvent):
+        if __debug__ and self._debug:
+            try:
+                self._handleKeyPress(keyEvent)
+            except Exception as ex:
+                print("Exception happened during key press: %s" % (ex))
+        else:
+            self._handleKeyPress(keyEvent)
 
-            if key_pressed == coin.SoKeyboardEvent.V:
-                self.fitObjectToWindow()
-                time.sleep(0.3)
+    def _handleKeyPress(self, keyEvent):
+        event = keyEvent.getEvent()
+        state = self.state
 
-            pos = event.getPosition()
-            self.d_az = int(pos[0])
-            self.d_el = int(pos[1])
-            self.d_az_init = self.d_az
-            self.d_el_init = self.d_el
-
-            # adjust new X, Y,Z values
-            if key_pressed != coin.SoKeyboardEvent.X:
-                self.camera.position.setValue(
-                    (
-                        self.x,
-                        self.y,
-                        self.z,
-                    )
-                )
-            # time.sleep(0.01) # delays for 10 ms
-        except Exception as ex:
-            print("Exception happened during key press: %s" % (ex))
+        key_pressed = event.getKey()
+        key_state = event.getState()
+
+        if state.trig_dirty:
+            state.refresh_trig()
+
+        handler = self._key_handlers.get(key_pressed)
+        if not handler:
+            return
+        handler()
+        if self.shut_down_flag:
+            return
+
+        pos = event.getPosition()
+        state.d_az_init = int(pos[0])
+        state.d_el_init = int(pos[1])
+
+        # adjust new X, Y,Z values on the next frame
+        state.cam_dirty = True
+        self._scheduleFrame()
+        # time.sleep(0.01) # delays for 10 ms
 
     ## Function to fit the all objects to window (The same as: View -> Standard views -> Fit All)
     def fitObjectToWindow(self):
@@ -242,7 +452,7 @@ class WalkView(QtGui.QDialog):
     def changeSpeed(self, text):
         try:
             new_speed = float(text)
-            self.walk_speed_mm = new_speed
+            self.state.walk_speed_mm = new_speed
             print("New speed: %.3f mm/keypress" % (new_speed))
         except Exception as ex:
             print("Exception happened during changeSpeed: %s" % (ex))
@@ -261,6 +471,7 @@ class WalkView(QtGui.QDialog):
         try:
             new_speed = float(text)
             self.mouse_speed = new_speed
+            self._update_mouse_gain()
             print("New mouse speed: %.3f" % (new_speed))
         except Exception as ex:
             print("Exception happened during changeMouseSpeed: %s" % (ex))
@@ -304,11 +515,16 @@ class WalkView(QtGui.QDialog):
                 coin.SoKeyboardEvent.getClassTypeId(),
                 self.keyEvent,
             )
+            self._flush_timer.stop()
+            for shortcut in self._shortcuts:
+                shortcut.setEnabled(False)
+                shortcut.deleteLater()
+            self._camera_sensor.detach()
             print("Setting Orthographic view")
             Gui.ActiveDocument.ActiveView.setCameraType("Orthographic")
             # print("Setting ViewFit to all object to screen")
             # Gui.SendMsgToActiveView("ViewFit")
-            FreeCADGui.getMainWindow().statusBar().clearMessage()
+            self._status_bar.clearMessage()
             closeMessage()
             self.close()
         except Exception as ex:
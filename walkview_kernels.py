@@ -0,0 +1,143 @@
+"""
+Numeric kernels of the WalkView navigation macro
+
+Run this file with Numba installed to build the ahead-of-time compiled
+_walkview_kernels extension next to it:
+
+    python walkview_kernels.py
+
+The build is optional and relies on numba.pycc, which is deprecated
+upstream. WalkView uses the compiled extension only when it was built from
+this exact file, otherwise it falls back to the kernels defined here.
+"""
+
+__author__ = "Radek Reznicek - 747Developments, Spectral Vectors"
+__copyright__ = "Copyright 2021, 747Developments, 2025 Spectral Vectors"
+__license__ = "GPL"
+__email__ = "support@747developments.com"
+__version__ = "1.2"
+
+import os
+import sys
+import zlib
+from math import sin, cos, pi, floor
+
+import numpy as np
+
+try:
+    from numba import njit
+
+    HAVE_NUMBA = True
+except ImportError:
+    # Numba is optional, fall back to plain Python kernels
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+DEG2RAD = pi / 180.0
+RAD2DEG = 180.0 / pi
+
+# Sine lookup table, the extra entry wraps around to simplify interpolation
+SIN_TABLE_SIZE = 1024
+_SIN_TABLE = np.array([sin(2.0 * pi * i / SIN_TABLE_SIZE) for i in range(SIN_TABLE_SIZE + 1)])
+_SIN_TABLE_SCALE = SIN_TABLE_SIZE / (2.0 * pi)
+
+## Signatures shared by the JIT declarations and the AOT exports
+FAST_TRIG_SIGNATURE = "float64(float64)"
+UPDATE_ANGLE_SIGNATURE = "float64(float64, float64, boolean)"
+
+
+if HAVE_NUMBA:
+
+    ## Fast sine approximation from the lookup table with linear interpolation
+    @njit(FAST_TRIG_SIGNATURE, cache=True, fastmath=True)
+    def fast_sin(x):
+        t = x * _SIN_TABLE_SCALE
+        t_floor = floor(t)
+        i = int(t_floor) & (SIN_TABLE_SIZE - 1)
+        f = t - t_floor
+        return _SIN_TABLE[i] + f * (_SIN_TABLE[i + 1] - _SIN_TABLE[i])
+
+    ## Fast cosine approximation, cos(x) == sin(x + pi/2)
+    @njit(FAST_TRIG_SIGNATURE, cache=True, fastmath=True)
+    def fast_cos(x):
+        return fast_sin(x + pi / 2.0)
+
+else:
+    # The lookup table only pays off in compiled code, interpreted it is
+    # about 10x slower than libm
+    fast_sin = sin
+    fast_cos = cos
+
+
+## Function to update azimuth
+@njit(UPDATE_ANGLE_SIGNATURE, cache=True, fastmath=True)
+def update_az(value, increment, positive_incr):
+    value_deg = value * RAD2DEG
+    value_deg = value_deg % 360
+    if positive_incr:
+        new_value = value_deg + increment
+    else:
+        new_value = value_deg - increment
+    return new_value * DEG2RAD
+
+
+## Function to update elevation
+@njit(UPDATE_ANGLE_SIGNATURE, cache=True, fastmath=True)
+def update_el(value, increment, positive_incr):
+    value_deg = value * RAD2DEG
+    value_mod = value_deg % 360
+    if positive_incr:
+        new_value = value_deg + increment
+    else:
+        new_value = value_deg - increment
+    if new_value < 90 or new_value > 270:
+        new_value = value_mod
+    return new_value * DEG2RAD
+
+
+## Fingerprint of this file, baked into the extension to detect stale builds
+def source_fingerprint():
+    with open(os.path.abspath(__file__), "rb") as source:
+        return zlib.crc32(source.read())
+
+
+## Return the compiled extension if it was built from this file, else this module
+def load_kernels():
+    try:
+        import _walkview_kernels
+    except ImportError:
+        return sys.modules[__name__]
+    if _walkview_kernels.kernels_fingerprint() != source_fingerprint():
+        print(
+            "_walkview_kernels is out of date, using the JIT kernels. "
+            "Rebuild it with: python walkview_kernels.py"
+        )
+        return sys.modules[__name__]
+    return _walkview_kernels
+
+
+## Build the _walkview_kernels extension with Numba's ahead-of-time compiler
+def build():
+    from numba.pycc import CC
+
+    fingerprint = source_fingerprint()
+
+    def kernels_fingerprint():
+        return fingerprint
+
+    cc = CC("_walkview_kernels")
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+    cc.export("kernels_fingerprint", "int64()")(kernels_fingerprint)
+    cc.export("fast_sin", FAST_TRIG_SIGNATURE)(fast_sin.py_func)
+    cc.export("fast_cos", FAST_TRIG_SIGNATURE)(fast_cos.py_func)
+    cc.export("update_az", UPDATE_ANGLE_SIGNATURE)(update_az.py_func)
+    cc.export("update_el", UPDATE_ANGLE_SIGNATURE)(update_el.py_func)
+    cc.compile()
+
+
+if __name__ == "__main__":
+
+    build()